@@ -1,7 +1,7 @@
 from argparse import ArgumentParser
 import logging
 from os import listdir, mkdir
-from os.path import join, exists, split, dirname, abspath
+from os.path import join, exists, split, splitext, dirname, abspath
 import numpy as np
 from audio_utils import calculate_mfcc
 
@@ -69,6 +69,12 @@ class DataAligner:
                 motion_file = join(self.motion_dir, recording)
                 audio_data, motion_data = self.align_recording(audio_file, motion_file)
                 np.savez(join(dst_dir, "data_%03d.npz" % (i + 1)), X=audio_data, Y=motion_data)
+                # mirrored motion (process_motions.py --mirror) is paired with the same speech
+                name, ext = splitext(recording)
+                mirrored_file = join(self.motion_dir, name + "_mirrored" + ext)
+                if exists(mirrored_file):
+                    audio_data, motion_data = self.align_recording(audio_file, mirrored_file)
+                    np.savez(join(dst_dir, "data_%03d_mirrored.npz" % (i + 1)), X=audio_data, Y=motion_data)
             else:
                 audio_data = self.contextualize(np.load(audio_file))
                 print(audio_data.shape)
@@ -2,18 +2,24 @@ import scipy.io.wavfile as wav
 from python_speech_features import mfcc
 import numpy as np
 
+# MFCC frame step in seconds
+WINSTEP = 0.01
+
 
 def average(arr, n):
+    """Averages every n successive rows of arr, incomplete group at the end is dropped"""
     end = n * int(len(arr) / n)
-    return np.mean(arr[:end].reshape(-1, n), 1)
+    return np.mean(arr[:end].reshape((-1, n) + arr.shape[1:]), 1)
 
 
-def calculate_mfcc(audio_filename: str):
+def calculate_mfcc(audio_filename: str, fps: int = 20):
     rate, data = wav.read(audio_filename)
     # make mono from stereo
     if len(data.shape) == 2:
         data = (data[:, 0] + data[:, 1]) / 2
-    mfccs = mfcc(data, winlen=0.02, winstep=0.01, samplerate=rate, numcep=26, nfft=1024)
-    # average to meet to framerate (20fps)
-    mfccs = [average(mfccs[:, i], 5) for i in range(26)]
-    return np.transpose(mfccs)
\ No newline at end of file
+    mfccs = mfcc(data, winlen=0.02, winstep=WINSTEP, samplerate=rate, numcep=26, nfft=1024)
+    # average to meet to framerate
+    n = int(round(1 / (WINSTEP * fps)))
+    if abs(n * WINSTEP * fps - 1) > 1e-9:
+        raise ValueError(f"fps must divide the MFCC rate of {1 / WINSTEP:.0f} frames per second, got {fps}")
+    return average(mfccs, n).astype(np.float32)
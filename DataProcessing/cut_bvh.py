@@ -3,8 +3,8 @@ from pymo.parsers import BVHParser
 from pymo.writers import BVHWriter
 
 
-def main(src: str, dst: str):
-    bvh_parser = BVHParser()
+def main(src: str, dst: str, cache_dir: str = None):
+    bvh_parser = BVHParser(cache_dir=cache_dir)
     data = bvh_parser.parse(src)
 
     target_fps = 20
@@ -26,5 +26,6 @@ if __name__ == '__main__':
     parser = ArgumentParser()
     parser.add_argument('--src', help='Source BHV file')
     parser.add_argument('--dst', help='Result BVH file path')
+    parser.add_argument('--cache_dir', default=None, help='Path to cache parsed BVH files')
     args = parser.parse_args()
-    main(args.src, args.dst)
\ No newline at end of file
+    main(args.src, args.dst, args.cache_dir)
\ No newline at end of file
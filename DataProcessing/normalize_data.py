@@ -15,9 +15,10 @@ if __name__ == '__main__':
     result_folder = Path(args.dst)
     result_folder.mkdir(parents=True, exist_ok=True)
     data_files = sorted(list(source_folder.glob("*npz")))
-    train_files = data_files[1:]
     dev_files = data_files[:1]
     assert dev_files[0].name == "data_001.npz"
+    # the mirrored copy of the dev recording is not used for training either
+    train_files = [f for f in data_files[1:] if f.name != "data_001_mirrored.npz"]
 
     train_array = create_motion_array(train_files)
     max_val, mean_pose = get_normalization_values(train_array)
@@ -1,21 +1,52 @@
 import numpy as np
 import logging
+import time
 from argparse import ArgumentParser
-from os import mkdir, listdir
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from os import mkdir, listdir, replace
 from os.path import exists, splitext, join
 
 from audio_utils import calculate_mfcc
 
 
-def process_folder(src_dir: str, dst_dir: str):
+def process_file(audio_path: str, dst_path: str, fps: int = 20):
+    """Extracts MFCCs of one recording into dst_path, returns their shape and the time it took"""
+    start = time.time()
+    mfccs = calculate_mfcc(audio_path, fps)
+    # write under a temporary name first, so an interrupted run never leaves a partial file
+    tmp_path = dst_path + '.tmp.npy'
+    np.save(tmp_path, mfccs)
+    replace(tmp_path, dst_path)
+    return mfccs.shape, time.time() - start
+
+
+def process_folder(src_dir: str, dst_dir: str, fps: int = 20, workers: int = 1):
     if not exists(dst_dir):
         mkdir(dst_dir)
 
-    for audio in listdir(src_dir):
-        recording_name, _ = splitext(audio)
-        mfccs = calculate_mfcc(join(src_dir, audio))
-        logging.info(f"{recording_name}:{mfccs.shape}")
-        np.save(join(dst_dir, recording_name + '.npy'), mfccs)
+    audios = sorted(listdir(src_dir))
+    recording_names = [splitext(audio)[0] for audio in audios]
+    audio_paths = [join(src_dir, audio) for audio in audios]
+    dst_paths = [join(dst_dir, recording_name + '.npy') for recording_name in recording_names]
+
+    start = time.time()
+    if workers > 1:
+        # MFCC extraction is CPU bound, results come back in the order of audio_paths
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(partial(process_file, fps=fps), audio_paths, dst_paths))
+    else:
+        results = [process_file(audio_path, dst_path, fps) for audio_path, dst_path in zip(audio_paths, dst_paths)]
+    elapsed = time.time() - start
+
+    for recording_name, (shape, seconds) in zip(recording_names, results):
+        logging.info(f"{recording_name}:{shape} {seconds:.2f}s")
+    if results:
+        timings = [seconds for _, seconds in results]
+        slowest = int(np.argmax(timings))
+        logging.info(f"{len(results)} files in {elapsed:.2f}s with {workers} worker(s): "
+                     f"{sum(timings):.2f}s of extraction, {np.mean(timings):.2f}s mean, "
+                     f"slowest {recording_names[slowest]} {timings[slowest]:.2f}s")
 
 
 if __name__ == '__main__':
@@ -23,6 +54,8 @@ if __name__ == '__main__':
     arg_parser = ArgumentParser()
     arg_parser.add_argument('--src_dir', help='Path to recorded speech folder')
     arg_parser.add_argument('--dst_dir', help='Path where extracted audio features will be stored')
+    arg_parser.add_argument('--fps', type=int, default=20, help='Frame rate of the features, must divide 100')
+    arg_parser.add_argument('--workers', type=int, default=1, help='Number of processes extracting features')
 
     args = arg_parser.parse_args()
-    process_folder(args.src_dir, args.dst_dir)
+    process_folder(args.src_dir, args.dst_dir, args.fps, args.workers)
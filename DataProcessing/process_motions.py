@@ -1,4 +1,6 @@
 from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from os import listdir, mkdir
 from os.path import join, splitext, exists, isdir, split
 
@@ -6,29 +8,30 @@ import numpy as np
 from sklearn.pipeline import Pipeline
 
 from pymo.parsers import BVHParser
-from pymo.preprocessing import DownSampler, RootTransformer, JointSelector, MocapParameterizer, ConstantsRemover, \
-    Numpyfier
+from pymo.data import RaggedArray
+from pymo.pipelines import save_pipeline, fit_pipeline_incrementally, load_pipeline as load_stored_pipeline
+from pymo.preprocessing import DownSampler, RootTransformer, Mirror, JointSelector, MocapParameterizer, \
+    ConstantsRemover, Numpyfier
 import logging
 import joblib as jl
 
 from pymo.writers import BVHWriter
 
 
-def process_folder(src_dir: str, dst_dir: str, pipeline_dir: str, fps: int = 20):
-    bvh_parser = BVHParser()
-    data = []
-    bvh_names = listdir(src_dir)
-    logging.info('Parsing BVH files...')
-    for bvh_name in bvh_names:
-        bvh_path = join(src_dir, bvh_name)
-        logging.info(bvh_path)
-        data.append(bvh_parser.parse(bvh_path))
+def parse_bvh(bvh_path: str, cache_dir: str = None):
+    logging.info(bvh_path)
+    return BVHParser(cache_dir=cache_dir).parse(bvh_path)
+
+
+def process_folder(src_dir: str, dst_dir: str, pipeline_dir: str, fps: int = 20, workers: int = 1,
+                   cache_dir: str = None, mirror: bool = False, corpus: str = None, stream: bool = False):
+    bvh_names = sorted(listdir(src_dir))
+    bvh_paths = [join(src_dir, bvh_name) for bvh_name in bvh_names]
 
     # pipeline from https://github.com/GestureGeneration/Speech_driven_gesture_generation_with_autoencoder
-    data_pipe = Pipeline([
+    steps = [
         ('dwnsampl', DownSampler(tgt_fps=fps, keep_all=False)),
         ('root', RootTransformer('hip_centric')),
-        # ('mir', Mirror(axis='X', append=True)),
         ('jtsel', JointSelector(
             ['Spine', 'Spine1', 'Spine2', 'Spine3', 'Neck', 'Neck1', 'Head', 'RightShoulder', 'RightArm',
              'RightForeArm', 'RightHand', 'LeftShoulder', 'LeftArm', 'LeftForeArm', 'LeftHand'],
@@ -36,27 +39,115 @@ def process_folder(src_dir: str, dst_dir: str, pipeline_dir: str, fps: int = 20)
         ('exp', MocapParameterizer('expmap')),
         ('cnst', ConstantsRemover()),
         ('np', Numpyfier())
-    ])
-    logging.info('Transforming data...')
-    out_data = data_pipe.fit_transform(data)
+    ]
+    if mirror:
+        steps.insert(2, ('mir', Mirror(axis='X', append=True)))
+    data_pipe = Pipeline(steps)
+
     if not exists(pipeline_dir):
         mkdir(pipeline_dir)
-    jl.dump(data_pipe, join(pipeline_dir, 'data_pipe.sav'))
-
-    logging.info('Saving result...')
     if not exists(dst_dir):
         mkdir(dst_dir)
-    for i, bvh_name in enumerate(bvh_names):
-        name, _ = splitext(bvh_name)
+    names = [splitext(bvh_name)[0] for bvh_name in bvh_names]
+    if mirror:
+        # Mirror appends the mirrored copies after all original recordings
+        names += [name + "_mirrored" for name in names]
+
+    if stream:
+        # one recording in memory at a time: every stateful step is fitted in a pass over all files,
+        # then each recording is transformed and saved in a last one
+        def recordings():
+            for bvh_path in bvh_paths:
+                yield [parse_bvh(bvh_path, cache_dir)]
+
+        logging.info('Fitting pipeline...')
+        fit_pipeline_incrementally(data_pipe, recordings)
+        save_pipeline(data_pipe, join(pipeline_dir, 'data_pipe'))
+        n_channels = len(data_pipe.named_steps['np'].org_mocap_.values.columns)
+
+        logging.info('Transforming data...')
+        for i, bvh_path in enumerate(bvh_paths):
+            out_data = data_pipe.transform([parse_bvh(bvh_path, cache_dir)])
+            for name, features in zip(names[i::len(bvh_paths)], out_data):
+                if features.shape[1] != n_channels:
+                    # the pipeline could not invert these features
+                    raise ValueError(f"{name} has {features.shape[1]} channels, the fitted pipeline {n_channels}")
+                logging.info(name)
+                np.save(join(dst_dir, name + ".npy"), features)
+
+        if corpus is not None:
+            logging.info(f'Saving {corpus}...')
+            RaggedArray.save_files(corpus, [join(dst_dir, name + ".npy") for name in names], names)
+        return
+
+    logging.info('Parsing BVH files...')
+    if workers > 1:
+        # parsing is CPU bound, results come back in the order of bvh_paths
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            data = list(executor.map(partial(parse_bvh, cache_dir=cache_dir), bvh_paths))
+    else:
+        data = [parse_bvh(bvh_path, cache_dir) for bvh_path in bvh_paths]
+
+    logging.info('Transforming data...')
+    out_data = data_pipe.fit_transform(data)
+    save_pipeline(data_pipe, join(pipeline_dir, 'data_pipe'))
+
+    logging.info('Saving result...')
+    for i, name in enumerate(names):
         logging.info(name)
         np.save(join(dst_dir, name + ".npy"), out_data[i])
 
+    if corpus is not None:
+        # all recordings in one memory-mappable file plus their offsets
+        logging.info(f'Saving {corpus}...')
+        out_data.names = names
+        out_data.save(corpus)
 
-def create_bvh(src: str, dst: str, pipeline_dir: str):
-    pipeline = jl.load(join(pipeline_dir, 'data_pipe.sav'))
+
+def load_pipeline(pipeline_dir: str):
+    if exists(join(pipeline_dir, 'data_pipe.json')):
+        return load_stored_pipeline(join(pipeline_dir, 'data_pipe'))
+    # pipelines pickled before data_pipe.json was introduced
+    return jl.load(join(pipeline_dir, 'data_pipe.sav'))
+
+
+def compute_positions(features: list, pipeline):
+    """Joint positions of the selected joints for motion features, without the Euler part of the inverse pipeline"""
+    data = pipeline.named_steps['np'].inverse_transform(features)
+    data = pipeline.named_steps['cnst'].inverse_transform(data)
+    positions = MocapParameterizer('expmap2pos').transform(data)
+    return [track.values.values for track in positions]
+
+
+def write_bvh(mocap, bvh_path: str):
+    logging.info(bvh_path)
+    with open(bvh_path, 'w') as f:
+        BVHWriter().write(mocap, f)
+
+
+def export_bvh(features: list, names: list, dst: str, pipeline, workers: int = 1):
+    logging.info("Transforming data")
+    bvh_data = pipeline.inverse_transform(features)
+
+    if not exists(dst):
+        mkdir(dst)
+    bvh_paths = [join(dst, name + '.bvh') for name in names]
+    logging.info("Saving bvh...")
+    if workers > 1:
+        # formatting the motion block is CPU bound, so files are written by separate processes
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(write_bvh, bvh_data, bvh_paths))
+    else:
+        for mocap, bvh_path in zip(bvh_data, bvh_paths):
+            write_bvh(mocap, bvh_path)
+
+
+def create_bvh(src: str, dst: str, pipeline_dir: str, workers: int = 1):
+    pipeline = load_pipeline(pipeline_dir)
     data = []
+    names = []
     if isdir(src):
-        recordings = [join(src, recording) for recording in listdir(src)]
+        recordings = [join(src, recording) for recording in sorted(listdir(src))]
     else:
         recordings = [src]
 
@@ -64,19 +155,11 @@ def create_bvh(src: str, dst: str, pipeline_dir: str):
         features = np.load(recording)
         logging.info(f"{recording} motion features shape: {features.shape}")
         data.append(features)
-    logging.info("Transforming data")
-    bvh_data = pipeline.inverse_transform(data)
-
-    if not exists(dst):
-        mkdir(dst)
-    writer = BVHWriter()
-    logging.info("Saving bvh...")
-    for i, recording in enumerate(recordings):
-        logging.info(recording)
         _, recording_filename = split(recording)
         recording_name, _ = splitext(recording_filename)
-        with open(join(dst, recording_name + '.bvh'), 'w') as f:
-            writer.write(bvh_data[i], f)
+        names.append(recording_name)
+
+    export_bvh(data, names, dst, pipeline, workers)
 
 
 if __name__ == '__main__':
@@ -86,9 +169,17 @@ if __name__ == '__main__':
     arg_parser.add_argument('--dst', help='Path where extracted features will be stored')
     arg_parser.add_argument('--pipeline_dir', default='./pipe', help='Path to save pipeline')
     arg_parser.add_argument('--bvh', action="store_true", help='Make bvh from features')
+    arg_parser.add_argument('--workers', type=int, default=1, help='Number of processes parsing or writing BVH files')
+    arg_parser.add_argument('--cache_dir', default=None, help='Path to cache parsed BVH files')
+    arg_parser.add_argument('--mirror', action="store_true", help='Also store motions mirrored along X axis')
+    arg_parser.add_argument('--corpus', default=None,
+                            help='Path prefix to also store all features in a single memory-mappable file')
+    arg_parser.add_argument('--stream', action="store_true",
+                            help='Fit and transform one recording at a time instead of loading all of them')
     args = arg_parser.parse_args()
     if args.bvh:
-        create_bvh(args.src, args.dst, args.pipeline_dir)
+        create_bvh(args.src, args.dst, args.pipeline_dir, args.workers)
     else:
-        process_folder(args.src, args.dst, args.pipeline_dir)
+        process_folder(args.src, args.dst, args.pipeline_dir, workers=args.workers, cache_dir=args.cache_dir,
+                       mirror=args.mirror, corpus=args.corpus, stream=args.stream)
 
@@ -20,23 +20,35 @@ class MocapData():
             joint = stack.pop()
             yield joint
             for c in self.skeleton[joint]['children']:
-                stack.append(c)
+                # joints removed by JointSelector are still listed as children
+                if c in self.skeleton:
+                    stack.append(c)
 
-    def clone(self):
+    def clone(self, deep=False):
+        '''
+        By default the clone shares the skeleton and channel names with this object
+        and gets a shallow copy of values that shares the channel array (with pandas
+        copy-on-write it is only copied once modified). Transformers are expected to
+        assign a new skeleton or values instead of editing them in place.
+        '''
         import copy
         new_data = MocapData()
-        new_data.skeleton = copy.deepcopy(self.skeleton)
-        new_data.values = copy.deepcopy(self.values)
-        new_data.channel_names = copy.deepcopy(self.channel_names)
-        new_data.root_name = copy.deepcopy(self.root_name)
-        new_data.framerate = copy.deepcopy(self.framerate)
+        if deep:
+            new_data.skeleton = copy.deepcopy(self.skeleton)
+            new_data.channel_names = copy.deepcopy(self.channel_names)
+        else:
+            new_data.skeleton = self.skeleton
+            new_data.channel_names = self.channel_names
+        if self.values is not None:
+            new_data.values = self.values.copy(deep=deep)
+        new_data.root_name = self.root_name
+        new_data.framerate = self.framerate
         return new_data
 
     def get_all_channels(self):
         '''Returns all of the channels parsed from the file as a 2D numpy array'''
 
-        frames = [f[1] for f in self.values]
-        return np.asarray([[channel[2] for channel in frame] for frame in frames])
+        return self.values.values
 
     def get_skeleton_tree(self):
         tree = []
@@ -51,3 +63,61 @@ class MocapData():
     def get_constant_channels(self):
         #TODO
         pass
+
+
+class RaggedArray():
+    '''
+    Sequences of different length stored in one contiguous (frames, channels) buffer.
+    The i-th sequence is the view data[offsets[i]:offsets[i+1]].
+    '''
+    def __init__(self, data, offsets, names=None):
+        self.data = data
+        self.offsets = np.asarray(offsets)
+        self.names = names
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.data[self.offsets[i]:self.offsets[i+1]]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def save(self, filename):
+        '''Stores the buffer in <filename>.npy and the offsets and names in <filename>_offsets.npz'''
+        np.save(filename + '.npy', self.data)
+        self._save_offsets(filename)
+
+    def _save_offsets(self, filename):
+        names = self.names if self.names is not None else []
+        np.savez(filename + '_offsets.npz', offsets=self.offsets, names=np.array(names, dtype=str))
+
+    @staticmethod
+    def save_files(filename, sources, names=None):
+        '''
+        Stores the arrays of the .npy files in sources like save, copying them one at a
+        time so they are never all in memory. Returns the memory-mapped result
+        '''
+        arrays = [np.load(source, mmap_mode='r') for source in sources]
+        offsets = np.zeros(len(arrays) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(array) for array in arrays])
+
+        data = np.lib.format.open_memmap(filename + '.npy', mode='w+', dtype=arrays[0].dtype,
+                                         shape=(int(offsets[-1]),) + arrays[0].shape[1:])
+        for i, array in enumerate(arrays):
+            data[offsets[i]:offsets[i+1]] = array
+        data.flush()
+
+        result = RaggedArray(data, offsets, names)
+        result._save_offsets(filename)
+        return result
+
+    @staticmethod
+    def load(filename, mmap_mode='r'):
+        '''Loads a stored buffer, by default memory-mapped so only the accessed sequences are read'''
+        data = np.load(filename + '.npy', mmap_mode=mmap_mode)
+        index = np.load(filename + '_offsets.npz')
+        names = [str(name) for name in index['names']] if len(index['names']) else None
+        return RaggedArray(data, index['offsets'], names)
@@ -7,7 +7,11 @@ Created: June 12, 2017
 Based on: https://gist.github.com/johnfredcee/2007503
 
 '''
+import hashlib
+import json
+import os
 import re
+from itertools import islice
 import numpy as np
 from pymo.data import Joint, MocapData
 
@@ -55,20 +59,30 @@ class BVHParser():
     A class to parse a BVH file.
     
     Extracts the skeleton and channel values
+
+    dtype sets the precision of the parsed channel values (np.float64 or np.float32)
+
+    If cache_dir is set, parsed files are stored there as a skeleton JSON plus a
+    memory-mapped .npy channel array and reused while the BVH file is unchanged.
+    The least recently used entries are removed once the cache exceeds cache_size bytes.
     '''
-    def __init__(self, filename=None):
+    def __init__(self, filename=None, dtype=np.float64, cache_dir=None, cache_size=4 * 1024**3):
+        self.dtype = dtype
+        self.cache_dir = cache_dir
+        self.cache_size = cache_size
         self.reset()
 
     def reset(self): 
         self._skeleton = {}
         self.bone_context = []
         self._motion_channels = []
-        self._motions = []
+        self._motions = np.empty((0, 0), dtype=self.dtype)
         self.current_token = 0
         self.framerate = 0.0
         self.root_name = ''
 
         self.scanner = BVHScanner()
+        self.motion_header = re.compile(r'MOTION\s+Frames:\s*(?P<frames>\d+)\s+Frame\s+Time:\s*(?P<frame_time>\S+)')
         
         self.data = MocapData()
 
@@ -76,13 +90,24 @@ class BVHParser():
     def parse(self, filename, start=0, stop=-1):
         self.reset()
 
-        with open(filename, 'r') as bvh_file:
-            raw_contents = bvh_file.read()
-        tokens, remainder = self.scanner.scan(raw_contents)
-        self._parse_hierarchy(tokens)
-        self.current_token = self.current_token + 1
-        self._parse_motion(tokens, start, stop)
-        
+        cache_key = None
+        if self.cache_dir is not None:
+            cache_key = self._cache_key(filename, start, stop)
+
+        if cache_key is None or not self._load_cache(cache_key):
+            with open(filename, 'r') as bvh_file:
+                raw_contents = bvh_file.read()
+
+            # Only the HIERARCHY section goes through the scanner, the MOTION block
+            # is plain numbers and is read in bulk by _parse_motion
+            motion_start = self._find_motion(raw_contents)
+            tokens, remainder = self.scanner.scan(raw_contents[:motion_start])
+            self._parse_hierarchy(tokens)
+            self._parse_motion(raw_contents[motion_start:], start, stop)
+
+            if cache_key is not None:
+                self._save_cache(cache_key)
+
         self.data.skeleton = self._skeleton
         self.data.channel_names = self._motion_channels
         self.data.values = self._to_DataFrame()
@@ -91,17 +116,156 @@ class BVHParser():
 
         return self.data
     
+    def iter_frames(self, filename, chunk_frames=1024, start=0, stop=-1):
+        '''
+        Yields the channel values of a BVH file as (frames, channels) arrays of
+        at most chunk_frames frames, reading the file incrementally.
+
+        The skeleton, channel names and framerate are available in self.data
+        (with values set to None) as soon as the first block is yielded.
+        '''
+        self.reset()
+
+        with open(filename, 'r') as bvh_file:
+            hierarchy = []
+            for line in bvh_file:
+                if line.strip() == 'MOTION':
+                    break
+                hierarchy.append(line)
+            else:
+                print('No motion section')
+                return
+
+            tokens, remainder = self.scanner.scan(''.join(hierarchy))
+            self._parse_hierarchy(tokens)
+            header = line + next(bvh_file, '') + next(bvh_file, '')
+            match, stop = self._parse_motion_header(header, start, stop)
+            if match is None:
+                return
+
+            self.data.skeleton = self._skeleton
+            self.data.channel_names = self._motion_channels
+            self.data.root_name = self.root_name
+            self.data.framerate = self.framerate
+
+            channel_count = len(self._motion_channels)
+            frames = islice(bvh_file, start, stop)
+            n_frames = 0
+            while True:
+                lines = list(islice(frames, chunk_frames))
+                if not lines:
+                    break
+                # fromstring does not fail on missing values, so every block is checked
+                values = np.fromstring(''.join(lines), dtype=self.dtype, sep=' ')
+                if values.size != len(lines)*channel_count:
+                    raise ValueError('Frames %d-%d have %d values, expected %d channels per frame'
+                                     %(start + n_frames, start + n_frames + len(lines) - 1, values.size, channel_count))
+                n_frames += len(lines)
+                yield values.reshape(len(lines), channel_count)
+
+            if n_frames < stop - start:
+                raise ValueError('MOTION block has %d frames, expected %d'%(n_frames, stop - start))
+
     def _to_DataFrame(self):
         '''Returns all of the channels parsed from the file as a pandas DataFrame'''
 
         import pandas as pd
-        time_index = pd.to_timedelta([f[0] for f in self._motions], unit='s')
-        frames = [f[1] for f in self._motions]
-        channels = np.asarray([[channel[2] for channel in frame] for frame in frames])
+        time_index = pd.to_timedelta(np.arange(self._motions.shape[0]) * self.framerate, unit='s')
+        channels = self._motions
         column_names = ['%s_%s'%(c[0], c[1]) for c in self._motion_channels]
 
-        return pd.DataFrame(data=channels, index=time_index, columns=column_names)
-
+        return pd.DataFrame(data=channels, index=time_index, columns=column_names, copy=False)
+
+
+    def _cache_key(self, filename, start, stop):
+        '''Builds the cache entry name from the file path, size, mtime and content hash'''
+        stat = os.stat(filename)
+        content_hash = hashlib.sha1()
+        with open(filename, 'rb') as bvh_file:
+            for chunk in iter(lambda: bvh_file.read(1 << 20), b''):
+                content_hash.update(chunk)
+
+        key = '%s|%d|%d|%s|%d|%d|%s'%(os.path.abspath(filename), stat.st_size, stat.st_mtime_ns,
+                                      content_hash.hexdigest(), start, stop, np.dtype(self.dtype).name)
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    def _load_cache(self, cache_key):
+        '''Restores the parsed file from the cache, returns False if there is no entry'''
+        meta_path = os.path.join(self.cache_dir, cache_key + '.json')
+        values_path = os.path.join(self.cache_dir, cache_key + '.npy')
+
+        # another process may evict the entry at any moment, a vanished file is a miss
+        try:
+            with open(meta_path, 'r') as meta_file:
+                meta = json.load(meta_file)
+            # copy-on-write mapping, so that downstream code can't modify the cached file
+            motions = np.load(values_path, mmap_mode='c')
+
+            # mark the entry as recently used for the eviction
+            os.utime(meta_path)
+            os.utime(values_path)
+        except FileNotFoundError:
+            return False
+
+        self._skeleton = meta['skeleton']
+        self._motion_channels = [tuple(c) for c in meta['channel_names']]
+        self.root_name = meta['root_name']
+        self.framerate = meta['framerate']
+        self._motions = motions
+        return True
+
+    def _save_cache(self, cache_key):
+        '''Stores the parsed file in the cache and evicts old entries'''
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        meta = {
+            'skeleton': self._skeleton,
+            'channel_names': self._motion_channels,
+            'root_name': self.root_name,
+            'framerate': self.framerate
+        }
+
+        # write to temporary files first, so that concurrent readers never see partial entries,
+        # named per process as several processes may store the same file at once
+        meta_path = os.path.join(self.cache_dir, cache_key + '.json')
+        values_path = os.path.join(self.cache_dir, cache_key + '.npy')
+        tmp_ext = '.%d.tmp'%os.getpid()
+        with open(values_path + tmp_ext, 'wb') as values_file:
+            np.save(values_file, self._motions)
+        with open(meta_path + tmp_ext, 'w') as meta_file:
+            json.dump(meta, meta_file)
+        os.replace(values_path + tmp_ext, values_path)
+        os.replace(meta_path + tmp_ext, meta_path)
+
+        self._evict_cache(cache_key)
+
+    def _evict_cache(self, keep_key):
+        '''Removes the least recently used entries until the cache fits into cache_size'''
+        entries = {}
+        for name in os.listdir(self.cache_dir):
+            key, ext = os.path.splitext(name)
+            if ext not in ('.json', '.npy'):
+                continue
+            # entries can be removed or replaced by other processes sharing the cache
+            try:
+                stat = os.stat(os.path.join(self.cache_dir, name))
+            except FileNotFoundError:
+                continue
+            size, used = entries.get(key, (0, 0))
+            entries[key] = (size + stat.st_size, max(used, stat.st_mtime))
+
+        total_size = sum(size for size, used in entries.values())
+        for key in sorted(entries, key=lambda k: entries[k][1]):
+            if total_size <= self.cache_size:
+                break
+            if key == keep_key:
+                continue
+            for ext in ('.json', '.npy'):
+                try:
+                    os.remove(os.path.join(self.cache_dir, key + ext))
+                except FileNotFoundError:
+                    pass
+            total_size -= entries[key][0]
 
     def _new_bone(self, parent, name):
         bone = {'parent': parent, 'channels': [], 'offsets': [], 'order': '','children': []}
@@ -213,48 +377,62 @@ class BVHParser():
         
         self.root_name = root_name
 
-    def _parse_motion(self, bvh, start, stop):
-        if bvh[self.current_token][0] != 'IDENT':
-            print('Unexpected text')
-            return None
-        if bvh[self.current_token][1] != 'MOTION':
+    def _find_motion(self, raw_contents):
+        '''Returns the position of the MOTION keyword in the raw file contents'''
+        match = self.motion_header.search(raw_contents)
+        if match is None:
             print('No motion section')
-            return None
-        self.current_token = self.current_token + 1
-        if bvh[self.current_token][1] != 'Frames':
-            return None
-        self.current_token = self.current_token + 1
-        frame_count = int(bvh[self.current_token][1])
-        
+            return len(raw_contents)
+        return match.start()
+
+    def _parse_motion_header(self, raw_motion, start, stop):
+        '''Reads the frame count and frame time, returns the header match and the clipped stop frame'''
+        match = self.motion_header.match(raw_motion)
+        if match is None:
+            print('Unexpected text')
+            return None, stop
+        frame_count = int(match.group('frames'))
+
         if stop<0 or stop>frame_count:
             stop = frame_count
-            
+
         assert(start>=0)
         assert(start<stop)
-        
-        self.current_token = self.current_token + 1
-        if bvh[self.current_token][1] != 'Frame':
-            return None
-        self.current_token = self.current_token + 1
-        if bvh[self.current_token][1] != 'Time':
-            return None
-        self.current_token = self.current_token + 1
-        frame_rate = float(bvh[self.current_token][1])
+
+        frame_rate = float(match.group('frame_time'))
 
         self.framerate = frame_rate
-       
-        self.current_token = self.current_token + 1
-       
-        frame_time = 0.0
-        self._motions = [()] * (stop-start)
-        idx=0
-        for i in range(stop):
-            channel_values = []
-            for channel in self._motion_channels:
-                channel_values.append((channel[0], channel[1], float(bvh[self.current_token][1])))
-                self.current_token = self.current_token + 1
-
-            if i>=start:
-                self._motions[idx] = (frame_time, channel_values)
-                frame_time = frame_time + frame_rate
-                idx+=1
+
+        return match, stop
+
+    def _parse_motion(self, raw_motion, start, stop):
+        match, stop = self._parse_motion_header(raw_motion, start, stop)
+        if match is None:
+            return None
+
+        # Every frame is stored on its own line, so the frames before start are
+        # skipped by looking for line breaks without converting their values
+        position = raw_motion.find('\n', match.end()) + 1
+        for i in range(start):
+            position = raw_motion.find('\n', position) + 1
+
+        # Frames after stop are not converted either
+        end = len(raw_motion)
+        if stop < int(match.group('frames')):
+            end = position
+            for i in range(stop-start):
+                end = raw_motion.find('\n', end) + 1
+                if end == 0:
+                    end = len(raw_motion)
+                    break
+
+        # Channel values are whitespace separated, so the kept frames are
+        # converted at once straight into an array of the final type.
+        # fromstring does not fail on missing values, so the count is checked here
+        channel_count = len(self._motion_channels)
+        values = np.fromstring(raw_motion[position:end], dtype=self.dtype, sep=' ')
+        if values.size < (stop-start)*channel_count:
+            raise ValueError('MOTION block has %d values, expected %d frames of %d channels'
+                             %(values.size, stop-start, channel_count))
+
+        self._motions = values[:(stop-start)*channel_count].reshape(stop-start, channel_count)
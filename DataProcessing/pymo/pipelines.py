@@ -0,0 +1,162 @@
+'''
+Storing fitted pymo pipelines without pickle
+
+A fitted sklearn Pipeline of pymo transformers is stored as <filename>.json with
+the steps, their parameters and fitted state (column lists, constant values,
+skeletons, rotation orders) and <filename>.npz with the numpy arrays of the state.
+Neither depends on the pandas or sklearn version the pipeline was fitted with.
+'''
+import inspect
+import json
+import os
+
+import numpy as np
+import pandas as pd
+from sklearn.pipeline import Pipeline
+
+from pymo import preprocessing
+from pymo.data import MocapData
+
+FORMAT_VERSION = 1
+
+_loaded = {}
+
+
+def _encode(value, arrays, key):
+    if isinstance(value, MocapData):
+        columns = value.values.columns if value.values is not None else []
+        return {'__mocap__': {
+            'skeleton': _encode(value.skeleton, arrays, key + '.skeleton'),
+            'channel_names': _encode(value.channel_names, arrays, key + '.channel_names'),
+            'framerate': value.framerate,
+            'root_name': value.root_name,
+            'columns': [str(c) for c in columns],
+            'dtypes': [str(value.values[c].dtype) for c in columns]}}
+    if isinstance(value, pd.Index):
+        return {'__index__': [_encode(v, arrays, key) for v in value]}
+    if isinstance(value, np.ndarray):
+        arrays[key] = value
+        return {'__array__': key}
+    if isinstance(value, np.dtype) or (isinstance(value, type) and issubclass(value, np.generic)):
+        return {'__dtype__': np.dtype(value).str}
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, dict):
+        return {str(k): _encode(v, arrays, '%s.%s'%(key, k)) for k, v in value.items()}
+    if isinstance(value, tuple):
+        return {'__tuple__': _encode(list(value), arrays, key)}
+    if isinstance(value, list):
+        return [_encode(v, arrays, '%s.%d'%(key, i)) for i, v in enumerate(value)]
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    raise TypeError('Cannot store %s of type %s'%(key, type(value).__name__))
+
+
+def _decode(value, arrays):
+    if isinstance(value, list):
+        return [_decode(v, arrays) for v in value]
+    if not isinstance(value, dict):
+        return value
+    if '__mocap__' in value:
+        state = value['__mocap__']
+        mocap = MocapData()
+        mocap.skeleton = _decode(state['skeleton'], arrays)
+        mocap.channel_names = _decode(state['channel_names'], arrays)
+        mocap.framerate = state['framerate']
+        mocap.root_name = state['root_name']
+        mocap.values = pd.DataFrame({c: pd.Series([], dtype=d) for c, d in zip(state['columns'], state['dtypes'])},
+                                    index=pd.to_timedelta([], unit='s'))
+        return mocap
+    if '__tuple__' in value:
+        return tuple(_decode(value['__tuple__'], arrays))
+    if '__index__' in value:
+        return pd.Index(_decode(value['__index__'], arrays))
+    if '__array__' in value:
+        return arrays[value['__array__']]
+    if '__dtype__' in value:
+        return np.dtype(value['__dtype__']).type
+    return {k: _decode(v, arrays) for k, v in value.items()}
+
+
+def _fits_first_recording_only(step):
+    '''Stateless steps and steps whose partial_fit only fits on the first call'''
+    return not hasattr(step, 'partial_fit') or getattr(step, 'fit_on_first_call', False)
+
+
+def fit_pipeline_incrementally(pipeline, recordings):
+    '''
+    Fits the pipeline while only one recording is in memory at a time. recordings() yields
+    the recordings (each a list of tracks) and is called once per step that accumulates
+    state with partial_fit: such a step sees every recording, passed through the already
+    fitted steps before it, before anything after it is fitted. The other steps only need
+    the first recording and are fit on it in the same pass as the next accumulating step
+    '''
+    steps = [step for _, step in pipeline.steps]
+    i = 0
+    while i < len(steps):
+        for j, X in enumerate(recordings()):
+            for fitted in steps[:i]:
+                X = fitted.transform(X)
+            if j > 0:
+                steps[i].partial_fit(X)
+                continue
+
+            while i < len(steps) - 1 and _fits_first_recording_only(steps[i]):
+                X = steps[i].fit(X).transform(X)
+                i += 1
+            steps[i].fit(X)
+            if _fits_first_recording_only(steps[i]):
+                break
+        i += 1
+    return pipeline
+
+
+def save_pipeline(pipeline, filename):
+    '''Stores a fitted pipeline of pymo transformers in <filename>.json and <filename>.npz'''
+    arrays = {}
+    steps = []
+    for name, step in pipeline.steps:
+        # transformers pickled by older versions may lack recently added parameters
+        signature = inspect.signature(type(step).__init__)
+        params = {p: getattr(step, p, signature.parameters[p].default) for p in signature.parameters if p != 'self'}
+        state = {k: v for k, v in vars(step).items() if k not in params}
+        steps.append({'name': name,
+                      'class': type(step).__name__,
+                      'params': _encode(params, arrays, name),
+                      'state': _encode(state, arrays, name)})
+
+    # write both files aside first, so a reader never sees a half written pipeline
+    np.savez(filename + '.tmp.npz', **arrays)
+    with open(filename + '.json.tmp', 'w') as f:
+        json.dump({'version': FORMAT_VERSION, 'steps': steps}, f)
+    os.replace(filename + '.tmp.npz', filename + '.npz')
+    os.replace(filename + '.json.tmp', filename + '.json')
+
+
+def load_pipeline(filename):
+    '''
+    Loads a pipeline stored by save_pipeline. The result is memoized until the files
+    change, so callers share it and should not modify it
+    '''
+    stamp = (os.path.getmtime(filename + '.json'), os.path.getmtime(filename + '.npz'))
+    key = os.path.abspath(filename)
+    if key in _loaded and _loaded[key][0] == stamp:
+        return _loaded[key][1]
+
+    with open(filename + '.json') as f:
+        stored = json.load(f)
+    if stored.get('version') != FORMAT_VERSION:
+        raise ValueError('Unsupported pipeline format version %s in %s.json'%(stored.get('version'), filename))
+
+    with np.load(filename + '.npz') as npz:
+        arrays = dict(npz)
+
+    steps = []
+    for step in stored['steps']:
+        transformer = getattr(preprocessing, step['class'])(**_decode(step['params'], arrays))
+        transformer.__dict__.update(_decode(step['state'], arrays))
+        steps.append((step['name'], transformer))
+
+    pipeline = Pipeline(steps)
+    _loaded[key] = (stamp, pipeline)
+    return pipeline
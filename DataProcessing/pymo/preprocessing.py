@@ -11,10 +11,30 @@ import pandas as pd
 import numpy as np
 import transforms3d as t3d
 import scipy.ndimage.filters as filters
+from scipy import signal
+from fractions import Fraction
 from scipy.spatial.transform import Rotation as R
 
+from pymo.data import RaggedArray
+from pymo.rotation_tools import flip_rotvecs
+
 from sklearn.base import BaseEstimator, TransformerMixin
 
+def _combine_moments(count, mean, m2, values):
+    '''
+    Adds values to a running count, mean and sum of squared deviations along the first
+    axis, so statistics can be accumulated track by track without concatenating them
+    '''
+    n = values.shape[0]
+    if n == 0:
+        return count, mean, m2
+    track_mean = values.mean(axis=0)
+    track_m2 = ((values - track_mean)**2).sum(axis=0)
+    delta = track_mean - mean
+    mean = mean + delta*n/(count + n)
+    m2 = m2 + track_m2 + delta**2*count*n/(count + n)
+    return count + n, mean, m2
+
 class MocapParameterizer(BaseEstimator, TransformerMixin):
     def __init__(self, param_type = 'euler'):
         '''
@@ -57,110 +77,136 @@ class MocapParameterizer(BaseEstimator, TransformerMixin):
             raise 'param types: euler, quat, expmap, position'
 
     def fix_rotvec(self, rots):
-        '''fix problems with discontinuous rotation vectors'''
-        new_rots = rots.copy()
-        
+        '''fix problems with discontinuous rotation vectors, rots is (frames, 3) or (frames, joints, 3)'''
+
         # Compute angles and alternative rotation angles
-        angs = np.linalg.norm(rots, axis=1)
+        angs = np.linalg.norm(rots, axis=-1)
         alt_angs=2*np.pi-angs
 
         #find discontinuities by checking if the alternative representation is closer
         d_angs = np.diff(angs, axis=0)
-        d_angs2 = alt_angs[1:]-angs[:-1]        
-        swps = np.where(np.abs(d_angs2)<np.abs(d_angs))[0]
-
-        #reshape into intervals where we should flip rotation axis
-        isodd = swps.shape[0] % 2 == 1
-        if isodd:
-            swps=swps[:-1]
-        intv = 1+swps.reshape((swps.shape[0]//2, 2))
-        
-        #flip rotations in selected intervals
-        for ii in range(intv.shape[0]):
-            new_ax = -rots[intv[ii,0]:intv[ii,1],:]/np.tile(angs[intv[ii,0]:intv[ii,1], None], (1,3))
-            new_angs = alt_angs[intv[ii,0]:intv[ii,1]]
-            new_rots[intv[ii,0]:intv[ii,1],:] = new_ax*np.tile(new_angs[:, None], (1,3))
+        d_angs2 = alt_angs[1:]-angs[:-1]
+        swps = np.abs(d_angs2)<np.abs(d_angs)
 
-        return new_rots
+        #flip rotations in the intervals between pairs of discontinuities
+        return flip_rotvecs(rots, swps)
         
-    def _to_pos(self, X):
-        '''Converts joints rotations in Euler angles to joint positions'''
-
-        Q = []
-        for track in X:
-            channels = []
-            titles = []
-            euler_df = track.values
-
-            # Create a new DataFrame to store the exponential map rep
-            pos_df = pd.DataFrame(index=euler_df.index)
-
-            # List the columns that contain rotation channels
-            rot_cols = [c for c in euler_df.columns if ('rotation' in c)]
-
-            # List the columns that contain position channels
-            pos_cols = [c for c in euler_df.columns if ('position' in c)]
-
-            # List the joints that are not end sites, i.e., have channels
-            joints = (joint for joint in track.skeleton)
-            
-            tree_data = {}
-
-            for joint in track.traverse():
-                parent = track.skeleton[joint]['parent']
-                rot_order = track.skeleton[joint]['order']
+    def _fk_topology(self, track):
+        '''
+        Precomputes the skeleton layout used by the forward kinematics:
+        joints in traversal order, parent indices, offsets, rotation orders
+        and the joints grouped by depth so that every level is computed at once
+        '''
+        joints = list(track.traverse())
+        index = {joint: i for i, joint in enumerate(joints)}
+        parents = np.array([index[track.skeleton[joint]['parent']] if joint != track.root_name else -1 for joint in joints])
+        offsets = np.array([track.skeleton[joint]['offsets'] for joint in joints], dtype=np.float64)
 
-                # Get the rotation columns that belong to this joint
-                rc = euler_df[[c for c in rot_cols if joint in c]]
+        depths = np.zeros(len(joints), dtype=int)
+        for i in range(1, len(joints)):
+            depths[i] = depths[parents[i]] + 1
+        levels = [np.where(depths == d)[0] for d in range(1, depths.max() + 1)] if len(joints) > 1 else []
 
-                # Get the position columns that belong to this joint
-                pc = euler_df[[c for c in pos_cols if joint in c]]
+        orders = [track.skeleton[joint]['order'] for joint in joints]
+        return {'joints': joints, 'parents': parents, 'offsets': offsets, 'orders': orders, 'levels': levels}
 
-                # Make sure the columns are organized in xyz order
-                if rc.shape[1] < 3:
-                    euler_values = [[0,0,0] for f in rc.iterrows()]
-                    rot_order = "XYZ"
-                else:
-                    euler_values = [[f[1]['%s_%srotation'%(joint, rot_order[0])], 
-                                     f[1]['%s_%srotation'%(joint, rot_order[1])], 
-                                     f[1]['%s_%srotation'%(joint, rot_order[2])]] for f in rc.iterrows()]
-
-                if pc.shape[1] < 3:
-                    pos_values = [[0,0,0] for f in pc.iterrows()]
-                else:
-                    pos_values =[[f[1]['%s_Xposition'%joint], 
-                                  f[1]['%s_Yposition'%joint], 
-                                  f[1]['%s_Zposition'%joint]] for f in pc.iterrows()]
-                
-                # Convert the eulers to rotation matrices
-                rotmats = R.from_euler(rot_order, euler_values, degrees=True).inv()                  
-                tree_data[joint]=[
-                                    [], # to store the rotation matrix
-                                    []  # to store the calculated position
-                                 ] 
-
-                if track.root_name == joint:
-                    tree_data[joint][0] = rotmats
-                    tree_data[joint][1] = pos_values
-                else:
-                    # for every frame i, multiply this joint's rotmat to the rotmat of its parent
-                    tree_data[joint][0] = rotmats*tree_data[parent][0]
+    def _forward_kinematics(self, topology, rotmats, translations):
+        '''
+        Computes the joint positions for all frames at once
 
-                    # add the position channel to the offset and store it in k, for every frame i
-                    k = pos_values + np.asarray(track.skeleton[joint]['offsets'])
+        rotmats: (frames, joints, 3, 3) local rotation matrices
+        translations: (frames, joints, 3) local translations of each joint relative to its parent
+        returns (frames, joints, 3) global positions
+        '''
+        parents = topology['parents']
+        global_rotmats = np.empty_like(rotmats)
+        positions = np.empty_like(translations)
+
+        global_rotmats[:, 0] = rotmats[:, 0]
+        positions[:, 0] = translations[:, 0]
+        for idx in topology['levels']:
+            parent_rotmats = global_rotmats[:, parents[idx]]
+            positions[:, idx] = positions[:, parents[idx]] + np.einsum('fjab,fjb->fja', parent_rotmats, translations[:, idx])
+            global_rotmats[:, idx] = np.matmul(parent_rotmats, rotmats[:, idx])
+
+        return positions
+
+    def _fk_translations(self, topology, df):
+        '''The local translation is the offset plus the position channels, the root only uses its position channels'''
+        translations = np.tile(topology['offsets'], (df.shape[0], 1, 1))
+        translations[:, 0] = 0
+        for i, joint in enumerate(topology['joints']):
+            pos_cols = ['%s_%sposition'%(joint, axis) for axis in 'XYZ']
+            if all(c in df.columns for c in pos_cols):
+                translations[:, i] += df[pos_cols].values
+        return translations
 
-                    # multiply k to the rotmat of the parent for every frame i
-                    q = tree_data[parent][0].inv().apply(k)
+    def _to_pos(self, X):
+        '''Converts joints rotations in Euler angles to joint positions'''
 
-                    # add q to the position of the parent, for every frame i
-                    tree_data[joint][1] = tree_data[parent][1] + q
+        Q = []
+        for track in X:
+            euler_df = track.values
+            n_frames = euler_df.shape[0]
+            topology = self._fk_topology(track)
+            joints = topology['joints']
+
+            # Joints without rotation channels (e.g. end sites) keep the identity rotation
+            rotmats = np.tile(np.eye(3), (n_frames, len(joints), 1, 1))
+            orders = {}
+            for i, (joint, rot_order) in enumerate(zip(joints, topology['orders'])):
+                rot_cols = ['%s_%srotation'%(joint, axis) for axis in rot_order]
+                if len(rot_cols) == 3 and all(c in euler_df.columns for c in rot_cols):
+                    orders.setdefault(rot_order, []).append(i)
+
+            # Convert the eulers of all joints sharing a rotation order to rotation matrices in one call
+            for rot_order, idx in orders.items():
+                rot_cols = ['%s_%srotation'%(joints[i], axis) for i in idx for axis in rot_order]
+                euler = euler_df[rot_cols].values.reshape(-1, 3)
+                rotmats[:, idx] = R.from_euler(rot_order, euler, degrees=True).as_matrix().reshape(n_frames, len(idx), 3, 3)
+
+            translations = self._fk_translations(topology, euler_df)
+            positions = self._forward_kinematics(topology, rotmats, translations)
+
+            pos_cols = ['%s_%sposition'%(joint, axis) for joint in joints for axis in 'XYZ']
+            pos_df = pd.DataFrame(data=positions.reshape(n_frames, -1), index=euler_df.index, columns=pos_cols, copy=False)
 
+            new_track = track.clone()
+            new_track.values = pos_df
+            Q.append(new_track)
+        return Q
 
-                # Create the corresponding columns in the new DataFrame
-                pos_df['%s_Xposition'%joint] = pd.Series(data=[e[0] for e in tree_data[joint][1]], index=pos_df.index)
-                pos_df['%s_Yposition'%joint] = pd.Series(data=[e[1] for e in tree_data[joint][1]], index=pos_df.index)
-                pos_df['%s_Zposition'%joint] = pd.Series(data=[e[2] for e in tree_data[joint][1]], index=pos_df.index)
+    def _expmap_to_pos(self, X):
+        '''Converts joints rotations in Exponential Maps directly to joint positions'''
 
+        Q = []
+        for track in X:
+            exp_df = track.values
+            n_frames = exp_df.shape[0]
+            topology = self._fk_topology(track)
+            joints = topology['joints']
+
+            # Joints without exponential map channels (end sites or removed constants) keep the identity rotation
+            rotmats = np.tile(np.eye(3), (n_frames, len(joints), 1, 1))
+            orders = {}
+            for i, (joint, rot_order) in enumerate(zip(joints, topology['orders'])):
+                exp_cols = ['%s_%s'%(joint, p) for p in ['alpha', 'beta', 'gamma']]
+                if rot_order and all(c in exp_df.columns for c in exp_cols):
+                    orders.setdefault(rot_order, []).append(i)
+
+            for rot_order, idx in orders.items():
+                exp_cols = ['%s_%s'%(joints[i], p) for i in idx for p in ['alpha', 'beta', 'gamma']]
+                rots = R.from_rotvec(np.array(exp_df[exp_cols].values).reshape(-1, 3))
+                # _to_expmap reads the Euler angles as extrinsic (lower case order), while the
+                # skeleton applies them as intrinsic rotations, so the angles are reinterpreted here
+                euler = rots.as_euler(rot_order.lower())
+                rotmats[:, idx] = R.from_euler(rot_order, euler).as_matrix().reshape(n_frames, len(idx), 3, 3)
+
+            translations = self._fk_translations(topology, exp_df)
+            positions = self._forward_kinematics(topology, rotmats, translations)
+
+            pos_cols = ['%s_%sposition'%(joint, axis) for joint in joints for axis in 'XYZ']
+            pos_df = pd.DataFrame(data=positions.reshape(n_frames, -1), index=exp_df.index, columns=pos_cols, copy=False)
 
             new_track = track.clone()
             new_track.values = pos_df
@@ -172,36 +218,37 @@ class MocapParameterizer(BaseEstimator, TransformerMixin):
 
         Q = []
         for track in X:
-            channels = []
-            titles = []
             euler_df = track.values
+            n_frames = euler_df.shape[0]
 
-            # Create a new DataFrame to store the exponential map rep
-            exp_df = euler_df.copy()
+            # List the joints that are not end sites, i.e., have channels
+            joints = [joint for joint in track.skeleton if 'Nub' not in joint]
+            orders = [track.skeleton[joint]['order'] for joint in joints]
 
-            # List the columns that contain rotation channels
-            rots = [c for c in euler_df.columns if ('rotation' in c and 'Nub' not in c)]
+            # List the rotation columns of every joint in its rotation order
+            rot_cols = ['%s_%srotation'%(joint, axis) for joint, rot_order in zip(joints, orders) for axis in rot_order]
 
-            # List the joints that are not end sites, i.e., have channels
-            joints = (joint for joint in track.skeleton if 'Nub' not in joint)
+            # The exponential map columns come first, in the order they used to be inserted at loc=0 joint by joint
+            exp_cols = ['%s_%s'%(joint, p) for joint in joints[::-1] for p in ['alpha', 'beta', 'gamma']]
+            rot_set = set(rot_cols)
+            other_cols = [c for c in euler_df.columns if c not in rot_set]
 
-            for joint in joints:
-                r = euler_df[[c for c in rots if joint in c]] # Get the columns that belong to this joint
-                rot_order = track.skeleton[joint]['order']
-                r1_col = '%s_%srotation'%(joint, rot_order[0])
-                r2_col = '%s_%srotation'%(joint, rot_order[1])
-                r3_col = '%s_%srotation'%(joint, rot_order[2])
-                
-                exp_df.drop([r1_col, r2_col, r3_col], axis=1, inplace=True)
-                euler = [[f[1][r1_col], f[1][r2_col], f[1][r3_col]] for f in r.iterrows()]
-                exps = np.array(self.fix_rotvec(R.from_euler(rot_order.lower(), euler, degrees=True).as_rotvec()))
+            # Convert all joints that share a rotation order with one batched call
+            euler = euler_df[rot_cols].values.reshape(n_frames, len(joints), 3)
+            exps = np.empty(euler.shape)
+            for rot_order in set(orders):
+                idx = [i for i, o in enumerate(orders) if o == rot_order]
+                rotvecs = R.from_euler(rot_order.lower(), euler[:, idx].reshape(-1, 3), degrees=True).as_rotvec()
+                exps[:, idx] = rotvecs.reshape(n_frames, len(idx), 3)
 
-                # Create the corresponding columns in the new DataFrame    
-                exp_df.insert(loc=0, column='%s_gamma'%joint, value=pd.Series(data=[e[2] for e in exps], index=exp_df.index))
-                exp_df.insert(loc=0, column='%s_beta'%joint, value=pd.Series(data=[e[1] for e in exps], index=exp_df.index))
-                exp_df.insert(loc=0, column='%s_alpha'%joint, value=pd.Series(data=[e[0] for e in exps], index=exp_df.index))
+            exps = self.fix_rotvec(exps)
+
+            # Create the new DataFrame in one allocation
+            data = np.empty((n_frames, len(exp_cols) + len(other_cols)))
+            data[:, :len(exp_cols)] = exps[:, ::-1].reshape(n_frames, -1)
+            data[:, len(exp_cols):] = euler_df[other_cols].values
+            exp_df = pd.DataFrame(data=data, index=euler_df.index, columns=exp_cols + other_cols, copy=False)
 
-            #print(exp_df.columns)
             new_track = track.clone()
             new_track.values = exp_df
             Q.append(new_track)
@@ -211,31 +258,34 @@ class MocapParameterizer(BaseEstimator, TransformerMixin):
     def _expmap_to_euler(self, X):
         Q = []
         for track in X:
-            channels = []
-            titles = []
             exp_df = track.values
-
-            # Create a new DataFrame to store the exponential map rep
-            euler_df = exp_df.copy()
-            
-            # List the columns that contain rotation channels
-            exp_params = [c for c in exp_df.columns if ( any(p in c for p in ['alpha', 'beta','gamma']) and 'Nub' not in c)]
+            n_frames = exp_df.shape[0]
 
             # List the joints that are not end sites, i.e., have channels
-            joints = (joint for joint in track.skeleton if 'Nub' not in joint)
-
-            for joint in joints:
-                r = exp_df[[c for c in exp_params if joint in c]] # Get the columns that belong to this joint
-                
-                euler_df.drop(['%s_alpha'%joint, '%s_beta'%joint, '%s_gamma'%joint], axis=1, inplace=True)
-                expmap = [[f[1]['%s_alpha'%joint], f[1]['%s_beta'%joint], f[1]['%s_gamma'%joint]] for f in r.iterrows()] # Make sure the columsn are organized in xyz order
-                rot_order = track.skeleton[joint]['order']
-                euler_rots = np.array(R.from_rotvec(expmap).as_euler(rot_order.lower(), degrees=True))
-                
-                # Create the corresponding columns in the new DataFrame    
-                euler_df['%s_%srotation'%(joint, rot_order[0])] = pd.Series(data=[e[0] for e in euler_rots], index=euler_df.index)
-                euler_df['%s_%srotation'%(joint, rot_order[1])] = pd.Series(data=[e[1] for e in euler_rots], index=euler_df.index)
-                euler_df['%s_%srotation'%(joint, rot_order[2])] = pd.Series(data=[e[2] for e in euler_rots], index=euler_df.index)
+            joints = [joint for joint in track.skeleton if 'Nub' not in joint]
+            orders = [track.skeleton[joint]['order'] for joint in joints]
+
+            # The exponential map columns of every joint, organized in xyz order
+            exp_cols = ['%s_%s'%(joint, p) for joint in joints for p in ['alpha', 'beta', 'gamma']]
+
+            # The Euler columns are appended after the remaining columns, joint by joint
+            rot_cols = ['%s_%srotation'%(joint, axis) for joint, rot_order in zip(joints, orders) for axis in rot_order]
+            exp_set = set(exp_cols)
+            other_cols = [c for c in exp_df.columns if c not in exp_set]
+
+            # Convert all joints that share a rotation order with one batched call
+            expmap = exp_df[exp_cols].values.reshape(n_frames, len(joints), 3)
+            euler_rots = np.empty(expmap.shape)
+            for rot_order in set(orders):
+                idx = [i for i, o in enumerate(orders) if o == rot_order]
+                eulers = R.from_rotvec(expmap[:, idx].reshape(-1, 3)).as_euler(rot_order.lower(), degrees=True)
+                euler_rots[:, idx] = eulers.reshape(n_frames, len(idx), 3)
+
+            # Create the new DataFrame in one allocation
+            data = np.empty((n_frames, len(other_cols) + len(rot_cols)))
+            data[:, :len(other_cols)] = exp_df[other_cols].values
+            data[:, len(other_cols):] = euler_rots.reshape(n_frames, -1)
+            euler_df = pd.DataFrame(data=data, index=exp_df.index, columns=other_cols + rot_cols, copy=False)
 
             new_track = track.clone()
             new_track.values = euler_df
@@ -264,9 +314,6 @@ class Mirror(BaseEstimator, TransformerMixin):
                 Q.append(track)
             
         for track in X:
-            channels = []
-            titles = []
-            
             if self.axis == "X":
                 signs = np.array([1,-1,-1])
             if self.axis == "Y":
@@ -276,48 +323,44 @@ class Mirror(BaseEstimator, TransformerMixin):
 
             euler_df = track.values
 
-            # Create a new DataFrame to store the exponential map rep
-            new_df = pd.DataFrame(index=euler_df.index)
+            # Every column of the mirrored DataFrame is a column of the original one times a sign
+            new_cols = []
+            src_cols = []
+            col_signs = []
 
             # Copy the root positions into the new DataFrame
-            rxp = '%s_Xposition'%track.root_name
-            ryp = '%s_Yposition'%track.root_name
-            rzp = '%s_Zposition'%track.root_name
-            new_df[rxp] = pd.Series(data=-signs[0]*euler_df[rxp], index=new_df.index)
-            new_df[ryp] = pd.Series(data=-signs[1]*euler_df[ryp], index=new_df.index)
-            new_df[rzp] = pd.Series(data=-signs[2]*euler_df[rzp], index=new_df.index)
-            
-            # List the columns that contain rotation channels
-            rots = [c for c in euler_df.columns if ('rotation' in c and 'Nub' not in c)]
-            #lft_rots = [c for c in euler_df.columns if ('Left' in c and 'rotation' in c and 'Nub' not in c)]
-            #rgt_rots = [c for c in euler_df.columns if ('Right' in c and 'rotation' in c and 'Nub' not in c)]
-            lft_joints = (joint for joint in track.skeleton if 'Left' in joint and 'Nub' not in joint)
-            rgt_joints = (joint for joint in track.skeleton if 'Right' in joint and 'Nub' not in joint)
-                        
-            new_track = track.clone()
+            for i, axis in enumerate('XYZ'):
+                new_cols.append('%s_%sposition'%(track.root_name, axis))
+                src_cols.append('%s_%sposition'%(track.root_name, axis))
+                col_signs.append(-signs[i])
 
-            for lft_joint in lft_joints:                
+            # Swap the rotations of the left and right joints
+            lft_joints = (joint for joint in track.skeleton if 'Left' in joint and 'Nub' not in joint)
+            for lft_joint in lft_joints:
                 rgt_joint = lft_joint.replace('Left', 'Right')
-                
-                # Create the corresponding columns in the new DataFrame                
-                new_df['%s_Xrotation'%lft_joint] = pd.Series(data=signs[0]*track.values['%s_Xrotation'%rgt_joint], index=new_df.index)
-                new_df['%s_Yrotation'%lft_joint] = pd.Series(data=signs[1]*track.values['%s_Yrotation'%rgt_joint], index=new_df.index)
-                new_df['%s_Zrotation'%lft_joint] = pd.Series(data=signs[2]*track.values['%s_Zrotation'%rgt_joint], index=new_df.index)
-                
-                new_df['%s_Xrotation'%rgt_joint] = pd.Series(data=signs[0]*track.values['%s_Xrotation'%lft_joint], index=new_df.index)
-                new_df['%s_Yrotation'%rgt_joint] = pd.Series(data=signs[1]*track.values['%s_Yrotation'%lft_joint], index=new_df.index)
-                new_df['%s_Zrotation'%rgt_joint] = pd.Series(data=signs[2]*track.values['%s_Zrotation'%lft_joint], index=new_df.index)
-    
+                for dst_joint, src_joint in [(lft_joint, rgt_joint), (rgt_joint, lft_joint)]:
+                    for i, axis in enumerate('XYZ'):
+                        new_cols.append('%s_%srotation'%(dst_joint, axis))
+                        src_cols.append('%s_%srotation'%(src_joint, axis))
+                        col_signs.append(signs[i])
+
             # List the joints that are not left or right, i.e. are on the trunk
             joints = (joint for joint in track.skeleton if 'Nub' not in joint and 'Left' not in joint and 'Right' not in joint)
-
             for joint in joints:
-                # Create the corresponding columns in the new DataFrame
-                new_df['%s_Xrotation'%joint] = pd.Series(data=signs[0]*track.values['%s_Xrotation'%joint], index=new_df.index)
-                new_df['%s_Yrotation'%joint] = pd.Series(data=signs[1]*track.values['%s_Yrotation'%joint], index=new_df.index)
-                new_df['%s_Zrotation'%joint] = pd.Series(data=signs[2]*track.values['%s_Zrotation'%joint], index=new_df.index)
+                for i, axis in enumerate('XYZ'):
+                    new_cols.append('%s_%srotation'%(joint, axis))
+                    src_cols.append('%s_%srotation'%(joint, axis))
+                    col_signs.append(signs[i])
+
+            # Gather the columns and flip their signs in bulk
+            src_idx = euler_df.columns.get_indexer(src_cols)
+            if (src_idx < 0).any():
+                raise KeyError([c for c, i in zip(src_cols, src_idx) if i < 0])
+            data = euler_df.values[:, src_idx]
+            data *= np.array(col_signs, dtype=data.dtype)
 
-            new_track.values = new_df
+            new_track = track.clone()
+            new_track.values = pd.DataFrame(data=data, index=euler_df.index, columns=new_cols, copy=False)
             Q.append(new_track)
 
         return Q
@@ -329,6 +372,9 @@ class JointSelector(BaseEstimator, TransformerMixin):
     '''
     Allows for filtering the mocap data to include only the selected joints
     '''
+    # partial_fit only fits on the first call, incremental fitting can stop after it
+    fit_on_first_call = True
+
     def __init__(self, joints, include_root=False):
         self.joints = joints
         self.include_root = include_root
@@ -342,17 +388,37 @@ class JointSelector(BaseEstimator, TransformerMixin):
         
         selected_joints.extend(self.joints)
 
+        # Group the columns by joint name in one pass, column names are <joint>_<channel>
+        columns = X[0].values.columns
+        joint_columns = {}
+        for i, c in enumerate(columns):
+            if 'Nub' not in c:
+                joint_columns.setdefault(c.rsplit('_', 1)[0], []).append(i)
+
+        selected_idx = []
         for joint_name in selected_joints:
-            selected_channels.extend([o for o in X[0].values.columns if (joint_name + "_") in o and 'Nub' not in o])
-        
+            selected_idx.extend(joint_columns.get(joint_name, []))
+        selected_channels = [columns[i] for i in selected_idx]
+
         self.selected_joints = selected_joints
         self.selected_channels = selected_channels
-        self.not_selected = X[0].values.columns.difference(selected_channels)
-        self.not_selected_values = {c:X[0].values[c].values[0] for c in self.not_selected}
+        self.not_selected = columns.difference(selected_channels)
+        first_frame = X[0].values.values[0]
+        self.not_selected_values = {c:first_frame[columns.get_loc(c)] for c in self.not_selected}
+
+        # Integer index of the selected channels, used for tracks with the same columns as X[0]
+        self.columns_ = columns
+        self.selected_idx_ = np.array(selected_idx, dtype=int)
 
         self.orig_skeleton = X[0].skeleton
         return self
 
+    def partial_fit(self, X, y=None):
+        '''The channels are selected on the first call, later calls keep them'''
+        if not hasattr(self, 'columns_'):
+            self.fit(X)
+        return self
+
     def transform(self, X, y=None):
         print("JointSelector")
         Q = []
@@ -360,10 +426,17 @@ class JointSelector(BaseEstimator, TransformerMixin):
         for track in X:
             t2 = track.clone()
             
-            for key in track.skeleton.keys():
-                if key not in self.selected_joints:
-                    t2.skeleton.pop(key)
-            t2.values = track.values[self.selected_channels]
+            t2.skeleton = {key: joint for key, joint in track.skeleton.items() if key in self.selected_joints}
+
+            if track.values.columns.equals(self.columns_):
+                selected_idx = self.selected_idx_
+            else:
+                # e.g. mirrored tracks have the same channels in another order
+                selected_idx = track.values.columns.get_indexer(self.selected_channels)
+                if (selected_idx < 0).any():
+                    raise KeyError([c for c, i in zip(self.selected_channels, selected_idx) if i < 0])
+            t2.values = pd.DataFrame(data=track.values.values[:, selected_idx], index=track.values.index,
+                                     columns=self.selected_channels, copy=False)
 
             Q.append(t2)
       
@@ -373,11 +446,19 @@ class JointSelector(BaseEstimator, TransformerMixin):
     def inverse_transform(self, X, copy=None):
         Q = []
 
+        not_selected_values = np.array([self.not_selected_values[d] for d in self.not_selected])
+
         for track in X:
             t2 = track.clone()
             t2.skeleton = self.orig_skeleton
-            for d in self.not_selected:
-                t2.values[d] = self.not_selected_values[d]
+
+            # Fill a full width array at once, the not selected channels get their fitted values
+            n_frames, n_channels = track.values.shape
+            data = np.empty((n_frames, n_channels + len(self.not_selected)))
+            data[:, :n_channels] = track.values.values
+            data[:, n_channels:] = not_selected_values
+            t2.values = pd.DataFrame(data=data, index=track.values.index,
+                                     columns=list(track.values.columns) + list(self.not_selected), copy=False)
             Q.append(t2)
 
         return Q
@@ -387,9 +468,15 @@ class Numpyfier(BaseEstimator, TransformerMixin):
     '''
     Just converts the values in a MocapData object into a numpy array
     Useful for the final stage of a pipeline before training
+
+    All tracks are copied into one contiguous buffer of the given dtype,
+    transform returns a RaggedArray of views into it
     '''
-    def __init__(self):
-        pass
+    # partial_fit only fits on the first call, incremental fitting can stop after it
+    fit_on_first_call = True
+
+    def __init__(self, dtype=np.float32):
+        self.dtype = dtype
 
     def fit(self, X, y=None):
         self.org_mocap_ = X[0].clone()
@@ -397,15 +484,21 @@ class Numpyfier(BaseEstimator, TransformerMixin):
 
         return self
 
+    def partial_fit(self, X, y=None):
+        if not hasattr(self, 'org_mocap_'):
+            self.fit(X)
+        return self
+
     def transform(self, X, y=None):
         print("Numpyfier")
-        Q = []
-        
-        for track in X:
-            Q.append(track.values.values)
-            #print("Numpyfier:" + str(track.values.columns))
+        offsets = np.zeros(len(X) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([track.values.shape[0] for track in X])
+
+        data = np.empty((offsets[-1], X[0].values.shape[1]), dtype=self.dtype)
+        for i, track in enumerate(X):
+            data[offsets[i]:offsets[i+1]] = track.values.values
             
-        return np.array(Q)
+        return RaggedArray(data, offsets)
 
     def inverse_transform(self, X, copy=None):
         Q = []
@@ -415,7 +508,8 @@ class Numpyfier(BaseEstimator, TransformerMixin):
             new_mocap = self.org_mocap_.clone()
             time_index = pd.to_timedelta([f for f in range(track.shape[0])], unit='s')
 
-            new_df =  pd.DataFrame(data=track, index=time_index, columns=self.org_mocap_.values.columns)
+            # track may be a view into a (memory-mapped) RaggedArray, it is not copied here
+            new_df =  pd.DataFrame(data=track, index=time_index, columns=self.org_mocap_.values.columns, copy=False)
             
             new_mocap.values = new_df
             
@@ -427,11 +521,20 @@ class Numpyfier(BaseEstimator, TransformerMixin):
 class Slicer(BaseEstimator, TransformerMixin):
     '''
     Slice the data into intervals of equal size 
+
+    With views=True transform returns, for every track, a read-only
+    (n_sequences, window_size, channels) strided view of its values instead
+    of copying the windows, and inverse_transform blends such windows back
+    into tracks by overlap-add. dtype materializes the windows in that type.
     '''
-    def __init__(self, window_size, overlap=0.5):
+    # partial_fit only fits on the first call, incremental fitting can stop after it
+    fit_on_first_call = True
+
+    def __init__(self, window_size, overlap=0.5, views=False, dtype=None):
         self.window_size = window_size
         self.overlap = overlap
-        pass
+        self.views = views
+        self.dtype = dtype
 
     def fit(self, X, y=None):
         self.org_mocap_ = X[0].clone()
@@ -439,28 +542,37 @@ class Slicer(BaseEstimator, TransformerMixin):
 
         return self
 
+    def partial_fit(self, X, y=None):
+        if not hasattr(self, 'org_mocap_'):
+            self.fit(X)
+        return self
+
+    def _windows(self, vals):
+        '''Strided view of all windows of a (frames, channels) array, no data is copied'''
+        overlap_frames = (int)(self.overlap*self.window_size)
+        step = self.window_size-overlap_frames
+        n_sequences = max((vals.shape[0]-overlap_frames)//step, 0)
+
+        # built from the strides of vals, so any memory layout (pandas is often column-major) is viewed as is
+        return np.lib.stride_tricks.as_strided(vals, shape=(n_sequences, self.window_size, vals.shape[1]),
+                                               strides=(step*vals.strides[0],) + vals.strides, writeable=False)
+
     def transform(self, X, y=None):
         print("Slicer")
-        Q = []
-        
-        for track in X:
-            vals = track.values.values
-            nframes = vals.shape[0]
-            overlap_frames = (int)(self.overlap*self.window_size)
-            
-            n_sequences = (nframes-overlap_frames)//(self.window_size-overlap_frames)
-            
-            if n_sequences>0:
-                y = np.zeros((n_sequences, self.window_size, vals.shape[1]))
+        Q = [self._windows(track.values.values) for track in X]
 
-                # extract sequences from the input data
-                for i in range(0,n_sequences):
-                    frameIdx = (self.window_size-overlap_frames) * i
-                    Q.append(vals[frameIdx:frameIdx+self.window_size,:])
+        if self.views:
+            if self.dtype is not None:
+                Q = [windows.astype(self.dtype) for windows in Q]
+            return Q
 
-        return np.array(Q)
+        # extract sequences from the input data into one array
+        return np.concatenate(Q).astype(self.dtype or np.float64, copy=False)
 
     def inverse_transform(self, X, copy=None):
+        if self.views:
+            return self._overlap_add(X)
+
         Q = []
 
         for track in X:
@@ -477,6 +589,36 @@ class Slicer(BaseEstimator, TransformerMixin):
 
         return Q
 
+    def _overlap_add(self, X):
+        '''Blends the (n_sequences, window_size, channels) windows of every track into one sequence'''
+        overlap_frames = (int)(self.overlap*self.window_size)
+        step = self.window_size-overlap_frames
+
+        # tapered weights so that overlapping windows cross-fade, none of them is zero
+        weights = np.hanning(self.window_size + 2)[1:-1]
+
+        Q = []
+        for windows in X:
+            n_sequences = windows.shape[0]
+            n_frames = (n_sequences-1)*step + self.window_size if n_sequences > 0 else 0
+            starts = step*np.arange(n_sequences)
+
+            values = np.zeros((n_frames, windows.shape[2]))
+            weight_sum = np.zeros(n_frames)
+            # frames at the same position in every window never collide, so each position is added at once
+            for j in range(self.window_size):
+                values[starts + j] += weights[j]*windows[:, j]
+                weight_sum[starts + j] += weights[j]
+            values /= weight_sum[:, None]
+
+            new_mocap = self.org_mocap_.clone()
+            time_index = pd.to_timedelta([f for f in range(n_frames)], unit='s')
+            new_mocap.values = pd.DataFrame(data=values, index=time_index, columns=self.org_mocap_.values.columns,
+                                            copy=False)
+            Q.append(new_mocap)
+
+        return Q
+
 class RootTransformer(BaseEstimator, TransformerMixin):
     def __init__(self, method, position_smoothing=0, rotation_smoothing=0):
         """
@@ -497,7 +639,6 @@ class RootTransformer(BaseEstimator, TransformerMixin):
 
         for track in X:
             if self.method == 'abdolute_translation_deltas':
-                new_df = track.values.copy()
                 xpcol = '%s_Xposition'%track.root_name
                 ypcol = '%s_Yposition'%track.root_name
                 zpcol = '%s_Zposition'%track.root_name
@@ -506,23 +647,27 @@ class RootTransformer(BaseEstimator, TransformerMixin):
                 dxpcol = '%s_dXposition'%track.root_name
                 dzpcol = '%s_dZposition'%track.root_name
                 
-                x=track.values[xpcol].copy()
-                z=track.values[zpcol].copy()
+                x = track.values[xpcol].values
+                z = track.values[zpcol].values
                 
                 if self.position_smoothing>0:
                     x_sm = filters.gaussian_filter1d(x, self.position_smoothing, axis=0, mode='nearest')    
                     z_sm = filters.gaussian_filter1d(z, self.position_smoothing, axis=0, mode='nearest')                    
-                    dx = pd.Series(data=x_sm, index=new_df.index).diff()
-                    dz = pd.Series(data=z_sm, index=new_df.index).diff()
+                    new_df = track.values.copy()
                     new_df[xpcol] = x-x_sm
                     new_df[zpcol] = z-z_sm
                 else:
-                    dx = x.diff()
-                    dz = z.diff()
-                    new_df.drop([xpcol, zpcol], axis=1, inplace=True)
-                    
-                dx[0] = dx[1]
-                dz[0] = dz[1]
+                    x_sm = x
+                    z_sm = z
+                    new_df = track.values.drop([xpcol, zpcol], axis=1)
+
+                # the first frame has no delta of its own, it repeats the next one
+                dx = np.empty_like(x_sm)
+                dz = np.empty_like(z_sm)
+                dx[1:] = np.diff(x_sm)
+                dz[1:] = np.diff(z_sm)
+                dx[:1] = dx[1:2]
+                dz[:1] = dz[1:2]
                 
                 new_df[dxpcol] = dx
                 new_df[dzpcol] = dz
@@ -535,27 +680,14 @@ class RootTransformer(BaseEstimator, TransformerMixin):
                 new_track = track.clone()
 
                 # Absolute columns
-                xp_col = '%s_Xposition'%track.root_name
-                yp_col = '%s_Yposition'%track.root_name
-                zp_col = '%s_Zposition'%track.root_name
+                root_cols = ['%s_%s'%(track.root_name, channel) for channel in
+                             ['Xposition', 'Yposition', 'Zposition', 'Xrotation', 'Yrotation', 'Zrotation']]
 
-                xr_col = '%s_Xrotation'%track.root_name
-                yr_col = '%s_Yrotation'%track.root_name
-                zr_col = '%s_Zrotation'%track.root_name
-                
-                new_df = track.values.copy()
+                values = track.values.values.copy()
+                values[:, track.values.columns.get_indexer(root_cols)] = 0
 
-                all_zeros = np.zeros(track.values[xp_col].values.shape)
-
-                new_df[xp_col] = pd.Series(data=all_zeros, index=new_df.index)
-                new_df[yp_col] = pd.Series(data=all_zeros, index=new_df.index)
-                new_df[zp_col] = pd.Series(data=all_zeros, index=new_df.index)
-
-                new_df[xr_col] = pd.Series(data=all_zeros, index=new_df.index)
-                new_df[yr_col] = pd.Series(data=all_zeros, index=new_df.index)
-                new_df[zr_col] = pd.Series(data=all_zeros, index=new_df.index)
-
-                new_track.values = new_df
+                new_track.values = pd.DataFrame(data=values, index=track.values.index, columns=track.values.columns,
+                                                copy=False)
 
             #print(new_track.values.columns)
             Q.append(new_track)
@@ -565,8 +697,6 @@ class RootTransformer(BaseEstimator, TransformerMixin):
     def inverse_transform(self, X, copy=None, start_pos=None):
         Q = []
 
-        #TODO: simplify this implementation
-
         startx = 0
         startz = 0
 
@@ -576,7 +706,6 @@ class RootTransformer(BaseEstimator, TransformerMixin):
         for track in X:
             new_track = track.clone()
             if self.method == 'abdolute_translation_deltas':
-                new_df = new_track.values
                 xpcol = '%s_Xposition'%track.root_name
                 ypcol = '%s_Yposition'%track.root_name
                 zpcol = '%s_Zposition'%track.root_name
@@ -585,28 +714,21 @@ class RootTransformer(BaseEstimator, TransformerMixin):
                 dxpcol = '%s_dXposition'%track.root_name
                 dzpcol = '%s_dZposition'%track.root_name
 
-                dx = track.values[dxpcol].values
-                dz = track.values[dzpcol].values
-
-                recx = [startx]
-                recz = [startz]
-
-                for i in range(dx.shape[0]-1):
-                    recx.append(recx[i]+dx[i+1])
-                    recz.append(recz[i]+dz[i+1])
+                # integrate the deltas from the start position, the first delta is ignored
+                recx = track.values[dxpcol].values.astype(np.float64)
+                recz = track.values[dzpcol].values.astype(np.float64)
+                recx[:1] = startx
+                recz[:1] = startz
+                recx = np.cumsum(recx)
+                recz = np.cumsum(recz)
 
-                # recx = [recx[i]+dx[i+1] for i in range(dx.shape[0]-1)]
-                # recz = [recz[i]+dz[i+1] for i in range(dz.shape[0]-1)]
-                # recx = dx[:-1] + dx[1:]
-                # recz = dz[:-1] + dz[1:]
+                new_df = track.values.drop([dxpcol, dzpcol], axis=1)
                 if self.position_smoothing > 0:                    
-                    new_df[xpcol] = pd.Series(data=new_df[xpcol]+recx, index=new_df.index)
-                    new_df[zpcol] = pd.Series(data=new_df[zpcol]+recz, index=new_df.index)
+                    new_df[xpcol] = new_df[xpcol].values+recx
+                    new_df[zpcol] = new_df[zpcol].values+recz
                 else:
-                    new_df[xpcol] = pd.Series(data=recx, index=new_df.index)
-                    new_df[zpcol] = pd.Series(data=recz, index=new_df.index)
-
-                new_df.drop([dxpcol, dzpcol], axis=1, inplace=True)
+                    new_df[xpcol] = recx
+                    new_df[zpcol] = recz
                 
                 new_track.values = new_df
             # end of abdolute_translation_deltas
@@ -698,7 +820,7 @@ class Flattener(BaseEstimator, TransformerMixin):
 
 class ConstantsRemover(BaseEstimator, TransformerMixin):
     '''
-    For now it just looks at the first track
+    Removes the channels that are constant over all tracks
     '''
 
     def __init__(self, eps = 1e-6):
@@ -706,24 +828,45 @@ class ConstantsRemover(BaseEstimator, TransformerMixin):
         
 
     def fit(self, X, y=None):
-        stds = X[0].values.std()
-        cols = X[0].values.columns.values
-        self.const_dims_ = [c for c in cols if (stds[c] < self.eps).any()]
-        self.const_values_ = {c:X[0].values[c].values[0] for c in cols if (stds[c] < self.eps).any()}
+        self.__dict__.pop('n_samples_seen_', None)
+        return self.partial_fit(X)
+
+    def partial_fit(self, X, y=None):
+        '''Adds the tracks to the running statistics of every channel and updates the constant ones'''
+        if not hasattr(self, 'n_samples_seen_'):
+            self.columns_ = X[0].values.columns
+            self.first_frame_ = X[0].values.values[0]
+            self.n_samples_seen_ = 0
+            self.mean_ = np.zeros(len(self.columns_))
+            self.m2_ = np.zeros(len(self.columns_))
+
+        cols = self.columns_
+        for track in X:
+            values = track.values.values
+            if not track.values.columns.equals(cols):
+                idx = track.values.columns.get_indexer(cols)
+                if (idx < 0).any():
+                    raise KeyError([c for c, i in zip(cols, idx) if i < 0])
+                values = values[:, idx]
+            self.n_samples_seen_, self.mean_, self.m2_ = _combine_moments(self.n_samples_seen_, self.mean_,
+                                                                          self.m2_, values)
+
+        # sample standard deviation, like pandas
+        stds = np.sqrt(self.m2_/max(self.n_samples_seen_ - 1, 1))
+        self.const_dims_ = [c for i, c in enumerate(cols) if stds[i] < self.eps]
+        self.const_values_ = {c:self.first_frame_[i] for i, c in enumerate(cols) if stds[i] < self.eps}
         return self
 
     def transform(self, X, y=None):
         Q = []
         
-
+        const_dims = set(self.const_dims_)
         for track in X:
             t2 = track.clone()
-            #for key in t2.skeleton.keys():
-            #    if key in self.ConstDims_:
-            #        t2.skeleton.pop(key)
-            #print(track.values.columns.difference(self.const_dims_))
-            t2.values.drop(self.const_dims_, axis=1, inplace=True)
-            #t2.values = track.values[track.values.columns.difference(self.const_dims_)]
+            keep_cols = [c for c in track.values.columns if c not in const_dims]
+            keep_idx = track.values.columns.get_indexer(keep_cols)
+            t2.values = pd.DataFrame(data=track.values.values[:, keep_idx], index=track.values.index,
+                                     columns=keep_cols, copy=False)
             Q.append(t2)
         
         return Q
@@ -731,11 +874,17 @@ class ConstantsRemover(BaseEstimator, TransformerMixin):
     def inverse_transform(self, X, copy=None):
         Q = []
         
+        const_values = np.array([self.const_values_[d] for d in self.const_dims_])
         for track in X:
             t2 = track.clone()
-            for d in self.const_dims_:
-                t2.values[d] = self.const_values_[d]
-#                t2.values.assign(d=pd.Series(data=self.const_values_[d], index = t2.values.index))
+
+            # Append all constant channels at once after the remaining ones
+            n_frames, n_channels = track.values.shape
+            data = np.empty((n_frames, n_channels + len(self.const_dims_)))
+            data[:, :n_channels] = track.values.values
+            data[:, n_channels:] = const_values
+            t2.values = pd.DataFrame(data=data, index=track.values.index,
+                                     columns=list(track.values.columns) + self.const_dims_, copy=False)
             Q.append(t2)
 
         return Q
@@ -745,13 +894,20 @@ class ListStandardScaler(BaseEstimator, TransformerMixin):
         self.is_DataFrame = is_DataFrame
     
     def fit(self, X, y=None):
-        if self.is_DataFrame:
-            X_train_flat = np.concatenate([m.values for m in X], axis=0)
-        else:
-            X_train_flat = np.concatenate([m for m in X], axis=0)
+        self.__dict__.pop('n_samples_seen_', None)
+        return self.partial_fit(X)
 
-        self.data_mean_ = np.mean(X_train_flat, axis=0)
-        self.data_std_ = np.std(X_train_flat, axis=0)
+    def partial_fit(self, X, y=None):
+        if not hasattr(self, 'n_samples_seen_'):
+            self.n_samples_seen_, self.mean_, self.m2_ = 0, 0.0, 0.0
+
+        for m in X:
+            values = np.asarray(m.values if self.is_DataFrame else m)
+            self.n_samples_seen_, self.mean_, self.m2_ = _combine_moments(self.n_samples_seen_, self.mean_,
+                                                                          self.m2_, values)
+
+        self.data_mean_ = self.mean_
+        self.data_std_ = np.sqrt(self.m2_/self.n_samples_seen_)
 
         return self
     
@@ -795,13 +951,21 @@ class ListMinMaxScaler(BaseEstimator, TransformerMixin):
         self.is_DataFrame = is_DataFrame
     
     def fit(self, X, y=None):
-        if self.is_DataFrame:
-            X_train_flat = np.concatenate([m.values for m in X], axis=0)
-        else:
-            X_train_flat = np.concatenate([m for m in X], axis=0)
-
-        self.data_max_ = np.max(X_train_flat, axis=0)
-        self.data_min_ = np.min(X_train_flat, axis=0)
+        self.__dict__.pop('data_max_', None)
+        self.__dict__.pop('data_min_', None)
+        return self.partial_fit(X)
+
+    def partial_fit(self, X, y=None):
+        for m in X:
+            values = np.asarray(m.values if self.is_DataFrame else m)
+            if values.shape[0] == 0:
+                continue
+            if not hasattr(self, 'data_max_'):
+                self.data_max_ = np.max(values, axis=0)
+                self.data_min_ = np.min(values, axis=0)
+            else:
+                self.data_max_ = np.maximum(self.data_max_, np.max(values, axis=0))
+                self.data_min_ = np.minimum(self.data_min_, np.min(values, axis=0))
 
         return self
     
@@ -841,36 +1005,95 @@ class ListMinMaxScaler(BaseEstimator, TransformerMixin):
             return np.array(Q)
         
 class DownSampler(BaseEstimator, TransformerMixin):
-    def __init__(self, tgt_fps, keep_all=True):
+    '''
+    Resamples the tracks to tgt_fps
+
+    Any ratio between the source and the target fps is supported: the channels are
+    low-pass filtered and resampled with a polyphase filter (the same filter as
+    scipy.signal.resample_poly, but with the edges padded by the first and last frames).
+    With anti_aliasing=False the frames are just picked, which needs an integer ratio.
+
+    With keep_all=True every phase-shifted copy of a track is returned, e.g. 3 copies
+    for 60 -> 20 fps. All of them are views of one buffer.
+    '''
+    def __init__(self, tgt_fps, keep_all=True, anti_aliasing=True):
         self.tgt_fps = tgt_fps
         self.keep_all = keep_all
+        self.anti_aliasing = anti_aliasing
         
     
     def fit(self, X, y=None):    
 
         return self
+
+    def _filtered(self, track, up, down):
+        '''
+        Low-pass filtered values upsampled by up. Returns the buffer and the step between
+        the frames of one phase in it
+        '''
+        values = track.values.values.astype(np.float64)
+
+        # filter angles on their continuous path so that the wrap at 180 degrees does not ring
+        rot_idx = [i for i, c in enumerate(track.values.columns) if c.endswith('rotation')]
+        values[:, rot_idx] = np.rad2deg(np.unwrap(np.deg2rad(values[:, rot_idx]), axis=0))
+
+        max_rate = max(up, down)
+        half_len = 10*max_rate
+        h = signal.firwin(2*half_len + 1, 1.0/max_rate, window=('kaiser', 5.0))*up
+
+        # pad with enough edge frames for the filter, so that the first output is a multiple of down
+        pad = half_len//up + 1
+        while (pad*up + half_len)%down != 0:
+            pad += 1
+        n_up = values.shape[0]*up
+        padded = np.pad(values, ((pad, pad), (0, 0)), mode='edge')
+        start = pad*up + half_len
+
+        if self.keep_all:
+            buffer = signal.upfirdn(h, padded, up, 1, axis=0)[start:start + n_up]
+            step = down
+        else:
+            # only the first phase is needed, let the polyphase filter skip the other ones
+            buffer = signal.upfirdn(h, padded, up, down, axis=0)[start//down:start//down - (-n_up//down)]
+            step = 1
+
+        buffer[:, rot_idx] = (buffer[:, rot_idx] + 180) % 360 - 180
+        return buffer, step
     
     def transform(self, X, y=None):
         Q = []
         
         for track in X:
             orig_fps=round(1.0/track.framerate)
-            rate = orig_fps//self.tgt_fps
-            if orig_fps%self.tgt_fps!=0:
-                print("error orig_fps (" + str(orig_fps) + ") is not dividable with tgt_fps (" + str(self.tgt_fps) + ")")
+            ratio = Fraction(self.tgt_fps)/Fraction(orig_fps)
+            up, down = ratio.numerator, ratio.denominator
+
+            if self.anti_aliasing:
+                print("resampling from " + str(orig_fps) + " to " + str(self.tgt_fps) + " fps")
+                buffer, step = self._filtered(track, up, down)
+                phases = down if self.keep_all else 1
+                start_time = track.values.index[0]
             else:
-                print("downsampling with rate: " + str(rate))
-                
-            #print(track.values.size)
-            for ii in range(0,rate):
+                if up != 1:
+                    raise ValueError("orig_fps (" + str(orig_fps) + ") is not dividable with tgt_fps (" +
+                                     str(self.tgt_fps) + "), use anti_aliasing=True")
+                print("downsampling with rate: " + str(down))
+                buffer, step = track.values.values, down
+                phases = down if self.keep_all else 1
+
+            for ii in range(phases):
                 new_track = track.clone()
-                new_track.values = track.values[ii:-1:rate].copy()            
-                #print(new_track.values.size)
-                #new_track = track[0:-1:self.rate]
+                # frames ii, ii+step, ... of the buffer, without copying
+                frames = buffer[ii::step]
+                if self.anti_aliasing:
+                    seconds = ii/(orig_fps*up) + np.arange(frames.shape[0])/self.tgt_fps
+                    index = start_time + pd.to_timedelta(seconds, unit='s')
+                else:
+                    index = track.values.index[ii::step]
+
+                new_track.values = pd.DataFrame(data=frames, index=index, columns=track.values.columns, copy=False)
                 new_track.framerate = 1.0/self.tgt_fps
                 Q.append(new_track)
-                if not self.keep_all:
-                    break
         
         return Q
         
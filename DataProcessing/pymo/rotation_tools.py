@@ -19,37 +19,41 @@ def deg2rad(x):
 def rad2deg(x):
     return x/math.pi*180
 
-def unroll(rots):
+def flip_rotvecs(rots, swps):
+    '''
+    Replaces the rotation vectors between every pair of discontinuities by the
+    same rotation around the opposite axis (with angle 2*pi - angle)
 
+    rots: (frames, ..., 3) rotation vectors, all trailing joints are processed at once
+    swps: (frames-1, ...) boolean mask, True where there is a discontinuity after the frame
+    '''
     new_rots = rots.copy()
-    
-    # Compute angles and alternative rotation angles
-    angs = np.linalg.norm(rots, axis=1)
-    dotprod = np.einsum('ij,ij->i', rots[:-1,:], rots[1:,:])
-    alt_angs=2*np.pi-angs
-
-    #find discontinuities
-    d_angs = np.diff(angs, axis=0)
-    d_angs2 = alt_angs[1:]-angs[:-1]
-    
+    if rots.shape[0] == 0:
+        return new_rots
+
+    angs = np.linalg.norm(rots, axis=-1)
+    alt_angs = 2*np.pi-angs
+
+    #every discontinuity toggles the flipping, an unpaired last one is ignored
+    toggles = np.zeros(angs.shape, dtype=int)
+    toggles[1:] = swps
+    parity = np.cumsum(toggles, axis=0)
+    total = parity[-1]
+    flip = (parity % 2 == 1) & ~((total % 2 == 1) & (parity == total))
+
+    new_rots[flip] = -rots[flip]/angs[flip][:, None]*alt_angs[flip][:, None]
+    return new_rots
+
+def unroll(rots):
+    '''rots: (frames, 3) or (frames, joints, 3) rotation vectors'''
+
     # check if dot product is <0
-    swps = np.where((dotprod<-1))[0]
-    #print(np.sum(swps))
+    dotprod = np.einsum('i...j,i...j->i...', rots[:-1], rots[1:])
+    swps = dotprod<-1
     #swps = np.where((np.abs(d_ax)>0.5))[0]
     #swps = np.where(np.abs(d_angs2)<np.abs(d_angs))[0]
 
-    #reshape into intervals where we should unroll the rotations
-    isodd = swps.shape[0] % 2 == 1
-    if isodd:
-        swps=swps[:-1]
-        #swps = np.append(swps, rots.shape[0]-1)
-    intv = 1+swps.reshape((swps.shape[0]//2, 2))
-    for ii in range(intv.shape[0]):
-        new_ax = -rots[intv[ii,0]:intv[ii,1],:]/np.tile(angs[intv[ii,0]:intv[ii,1], None], (1,3))
-        new_angs = alt_angs[intv[ii,0]:intv[ii,1]]
-        new_rots[intv[ii,0]:intv[ii,1],:] = new_ax*np.tile(new_angs[:, None], (1,3))
-
-    return new_rots
+    return flip_rotvecs(rots, swps)
     
 def euler2expmap(rot, order='XYZ',use_deg=False):
     if use_deg:
@@ -71,6 +75,60 @@ def expmap2euler(rot, order='XYZ',use_deg=False):
     else:
         return eul
 
+# Batched conversions
+#
+# The functions below take arrays of N rotations at once: Euler angles and
+# exponential maps as (N, 3), quaternions as (N, 4) in (w, x, y, z) order like
+# transforms3d, and rotation matrices as (N, 3, 3). Euler angles use the same
+# convention as euler2expmap/expmap2euler, i.e. rotating axes applied in the
+# given order, in radians unless use_deg is set. Exponential maps are returned
+# with angles in [0, pi].
+
+def _from_euler(eulers, order, use_deg):
+    return R.from_euler(order.upper(), eulers, degrees=use_deg)
+
+def _from_quat(quats):
+    return R.from_quat(np.roll(quats, -1, axis=-1))
+
+def _as_quat(rots):
+    return np.roll(rots.as_quat(), 1, axis=-1)
+
+def euler2expmap_batch(eulers, order='XYZ', use_deg=False):
+    return _from_euler(eulers, order, use_deg).as_rotvec()
+
+def expmap2euler_batch(expmaps, order='XYZ', use_deg=False):
+    return R.from_rotvec(expmaps).as_euler(order.upper(), degrees=use_deg)
+
+def euler2quat_batch(eulers, order='XYZ', use_deg=False):
+    return _as_quat(_from_euler(eulers, order, use_deg))
+
+def quat2euler_batch(quats, order='XYZ', use_deg=False):
+    return _from_quat(quats).as_euler(order.upper(), degrees=use_deg)
+
+def euler2mat_batch(eulers, order='XYZ', use_deg=False):
+    return _from_euler(eulers, order, use_deg).as_matrix()
+
+def mat2euler_batch(mats, order='XYZ', use_deg=False):
+    return R.from_matrix(mats).as_euler(order.upper(), degrees=use_deg)
+
+def expmap2quat_batch(expmaps):
+    return _as_quat(R.from_rotvec(expmaps))
+
+def quat2expmap_batch(quats):
+    return _from_quat(quats).as_rotvec()
+
+def expmap2mat_batch(expmaps):
+    return R.from_rotvec(expmaps).as_matrix()
+
+def mat2expmap_batch(mats):
+    return R.from_matrix(mats).as_rotvec()
+
+def quat2mat_batch(quats):
+    return _from_quat(quats).as_matrix()
+
+def mat2quat_batch(mats):
+    return _as_quat(R.from_matrix(mats))
+
 class Rotation():
     def __init__(self,rot, param_type, **params):
         self.rotmat = []
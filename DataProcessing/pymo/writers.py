@@ -2,8 +2,13 @@ import numpy as np
 import pandas as pd
 
 class BVHWriter():
-    def __init__(self):
-        pass
+    def __init__(self, precision=6, chunk_frames=1024):
+        '''
+        precision is the number of decimals written for each channel value,
+        the motion block is formatted chunk_frames frames at a time
+        '''
+        self.precision = precision
+        self.chunk_frames = chunk_frames
     
     def write(self, X, ofile, framerate=-1):
         
@@ -22,10 +27,13 @@ class BVHWriter():
         else:
             ofile.write('Frame Time: %f\n'%X.framerate)
 
-        # Writing the data
-        self.motions_ = np.asarray(self.motions_).T
-        lines = [" ".join(item) for item in self.motions_.astype(str)]
-        ofile.write("".join("%s\n"%l for l in lines))
+        # Writing the data, the channels are gathered into one (frames, channels) array
+        # and every chunk of frames is formatted with a single string operation
+        motions = X.values[self.motions_].values
+        line_format = ' '.join(['%%.%df'%self.precision] * motions.shape[1]) + '\n'
+        for i in range(0, motions.shape[0], self.chunk_frames):
+            chunk = motions[i:i+self.chunk_frames]
+            ofile.write((line_format * chunk.shape[0]) % tuple(chunk.ravel()))
 
     def _printJoint(self, X, joint, tab, ofile):
         
@@ -54,11 +62,11 @@ class BVHWriter():
         if n_channels > 0:
             for ci in range(len(pos)):
                 cn = pos[ci]
-                self.motions_.append(np.asarray(X.values['%s_%s'%(joint,cn)].values))
+                self.motions_.append('%s_%s'%(joint,cn))
                 ch_str = ch_str + ' ' + cn 
             for ci in range(len(rot)):
                 cn = '%srotation'%(rot_order[ci])
-                self.motions_.append(np.asarray(X.values['%s_%s'%(joint,cn)].values))
+                self.motions_.append('%s_%s'%(joint,cn))
                 ch_str = ch_str + ' ' + cn 
         if len(X.skeleton[joint]['children']) > 0:
             #ch_str = ''.join(' %s'*n_channels%tuple(channels))
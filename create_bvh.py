@@ -2,7 +2,6 @@ import logging
 from argparse import ArgumentParser
 from os import mkdir
 from os.path import exists
-from tempfile import TemporaryDirectory
 from pathlib import Path
 
 import numpy as np
@@ -11,7 +10,7 @@ from scipy.signal import savgol_filter
 import sys
 sys.path.append('./DataProcessing')
 from DataProcessing.reconstruct_data import load_mean, denormalize
-from DataProcessing.process_motions import create_bvh
+from DataProcessing.process_motions import load_pipeline, export_bvh
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -58,10 +57,20 @@ if __name__ == "__main__":
         default=False,
         help="Flag to apply smoothing."
         )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of processes writing .bvh files."
+    )
     args = parser.parse_args()
     if not exists(args.dest):
         mkdir(args.dest)
-    for pred_file in Path(args.pred).glob('*.npy'):
+
+    max_val, mean_pose = load_mean(args.mean)
+    predictions = []
+    names = []
+    for pred_file in sorted(Path(args.pred).glob('*.npy')):
         logging.info(str(pred_file))
         prediction = np.load(str(pred_file))
         if args.smooth:
@@ -69,12 +78,8 @@ if __name__ == "__main__":
             prediction = smoothing(prediction)
 
         logging.info("Reconstructing data by denormalizing it.")
-        max_val, mean_pose = load_mean(args.mean)
-        prediction = denormalize(prediction, max_val, mean_pose)
-
-        logging.info("Creating .bvh. This requires pipe")
+        predictions.append(denormalize(prediction, max_val, mean_pose))
+        names.append(pred_file.stem)
 
-        with TemporaryDirectory() as tmpdir:
-            tmpdir = Path(tmpdir)
-            np.save(tmpdir / pred_file.name, prediction)
-            create_bvh(tmpdir / pred_file.name, args.dest, args.pipe)
+    logging.info("Creating .bvh. This requires pipe")
+    export_bvh(predictions, names, args.dest, load_pipeline(args.pipe), args.workers)